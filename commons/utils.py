@@ -133,7 +133,9 @@ def fourier_encode_dist(x, num_encodings=4, include_self=True):
 
 
 def tensorboard_singular_value_plot(predictions, targets, writer: SummaryWriter, step, data_split):
-    u, s, v = torch.pca_lowrank(predictions.detach().cpu(), q=min(predictions.shape))
+    # decompose on the device of the outputs and only move the singular values to the cpu for plotting
+    u, s, v = torch.pca_lowrank(predictions.detach(), q=min(predictions.shape))
+    s = s.cpu()
     fig, ax = plt.subplots()
     s = 100 * s / s.sum()
     ax.plot(s.numpy())
@@ -158,15 +160,48 @@ TENSORBOARD_FUNCTIONS = {
     'singular_values': tensorboard_singular_value_plot
 }
 
-def move_to_device(element, device):
+class RunningMoments:
+    '''
+    mean and unbiased standard deviation over all elements of a stream of tensors. The batches are merged with the
+    parallel version of Welford's algorithm such that the tensors themselves do not have to be kept
+    '''
+
+    def __init__(self):
+        self.n = 0  # number of elements
+        self.n_rows = 0  # number of rows, i.e. samples
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+
+    def update(self, x: torch.Tensor):
+        n = x.numel()
+        if n == 0:
+            return
+        mean = x.mean().item()
+        m2 = ((x - mean) ** 2).sum().item()
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+        self.n_rows += len(x)
+
+    @property
+    def std(self):
+        # nan for less than two elements like torch.std
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else float('nan')
+
+
+def move_to_device(element, device, non_blocking=False):
     '''
     takes arbitrarily nested list and moves everything in it to device if it is a dgl graph or a torch tensor
     :param element: arbitrarily nested list
     :param device:
+    :param non_blocking: asynchronous copies, which only overlap with computation if the element is in pinned memory
     :return:
     '''
     if isinstance(element, list):
-        return [move_to_device(x, device) for x in element]
+        return [move_to_device(x, device, non_blocking) for x in element]
     else:
-        return element.to(device) if isinstance(element,(torch.Tensor, dgl.DGLGraph)) else element
+        return element.to(device, non_blocking=non_blocking) if isinstance(element, (torch.Tensor, dgl.DGLGraph)) \
+            else element
 
@@ -1,15 +1,29 @@
-import copy
 from typing import List, Tuple
 
 import dgl
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torch_geometric
 from torch.nn.utils.rnn import pad_sequence
 
 from commons.utils import get_adj_matrix
 
 
+def sequence_lengths(sequences: List[torch.Tensor]):
+    # int64 tensor of the first dimension of each sequence. Goes through numpy's buffer instead of letting
+    # torch.tensor infer the type and shape of a python list.
+    return torch.from_numpy(np.fromiter((sequence.shape[0] for sequence in sequences), dtype=np.int64,
+                                        count=len(sequences)))
+
+
+def padding_mask(lengths: torch.Tensor, max_length: int):
+    # mask corresponding to the zero padding of the sequences shorter than max_length: [batch_size, max_length].
+    # Both operands of the comparison are broadcast views, so only the arange of length max_length and the mask are
+    # allocated.
+    return torch.arange(max_length, device=lengths.device).unsqueeze(0) >= lengths.unsqueeze(1)
+
+
 def graph_collate(batch: List[Tuple]):
     graphs, targets = map(list, zip(*batch))
     batched_graph = dgl.batch(graphs)
@@ -56,10 +70,9 @@ def pyg_graph_only_collate(batch: List[Tuple]):
 
 def s_norm_graph_collate(batch: List[Tuple]):
     graphs, targets = map(list, zip(*batch))
-    tab_sizes_n = [graphs[i].number_of_nodes() for i in range(len(graphs))]
-    tab_snorm_n = [torch.FloatTensor(size, 1).fill_(1. / float(size)) for size in tab_sizes_n]
-    snorm_n = torch.cat(tab_snorm_n).sqrt()
     batched_graph = dgl.batch(graphs)
+    tab_sizes_n = batched_graph.batch_num_nodes()
+    snorm_n = torch.repeat_interleave(torch.rsqrt(tab_sizes_n.to(torch.float32)), tab_sizes_n).unsqueeze(1)
     return [batched_graph, snorm_n], torch.stack(targets).float()
 
 
@@ -89,7 +102,7 @@ def pairwise_distance_collate(batch: List[Tuple]):
     n_atoms = batched_dgl_graph.batch_num_nodes()
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    mask = torch.arange(n_atoms.max(), device=distances[0].device)[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, n_atoms.max())  # [batch_size, n_atoms]
     return [batched_dgl_graph, torch.cat(pairwise_indices, dim=-1), mask], torch.cat(distances)
 
 
@@ -100,18 +113,16 @@ def contrastive_graphs_with_mask_collate(batch: List[Tuple]):
     n_atoms = batched_dgl_graph.batch_num_nodes()
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    mask = torch.arange(n_atoms.max(), device=batched_dgl_graph.device)[None, :] >= n_atoms[:,
-                                                                                    None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, n_atoms.max())  # [batch_size, n_atoms]
     return [batched_dgl_graph, mask], [dgl.batch(complete_graph3d)]
 
 
 def s_norm_contrastive_collate(batch: List[Tuple]):
     # optionally take targets
     graphs, graphs3d = map(list, zip(*batch))
-    tab_sizes_n = [graphs[i].number_of_nodes() for i in range(len(graphs))]
-    tab_snorm_n = [torch.FloatTensor(size, 1).fill_(1. / float(size)) for size in tab_sizes_n]
-    snorm_n = torch.cat(tab_snorm_n).sqrt()
     batched_graph = dgl.batch(graphs)
+    tab_sizes_n = batched_graph.batch_num_nodes()
+    snorm_n = torch.repeat_interleave(torch.rsqrt(tab_sizes_n.to(torch.float32)), tab_sizes_n).unsqueeze(1)
     batched_graph3d = dgl.batch(graphs3d)
 
     return [batched_graph, snorm_n], [batched_graph3d]
@@ -124,7 +135,7 @@ def contrastive_collate(batch: List[Tuple]):
     batched_graph3d = dgl.batch(graphs3d)
 
     if targets:
-        return [batched_graph], [batched_graph3d], torch.stack(*targets).float()
+        return [batched_graph], [batched_graph3d], torch.stack(targets[0]).float()
     else:
         return [batched_graph], [batched_graph3d]
 
@@ -143,28 +154,79 @@ def pytorch_geometric2d_contrastive_collate(batch: List[Tuple]):
     return [batched_graph], [batched_graph3d]
 
 
+def pin_collate_output(data):
+    # recursively pin the tensors and DGL graphs of a collate output
+    if isinstance(data, torch.Tensor):
+        return data.pin_memory()
+    if isinstance(data, dgl.DGLGraph):
+        return data.pin_memory_()
+    if isinstance(data, (list, tuple)):
+        return type(data)(pin_collate_output(element) for element in data)
+    return data
+
+
+class PinnedBatch(object):
+    """
+    Collate output that DataLoader(pin_memory=True) pins in its pin memory thread of the main process while the
+    training step runs. The DataLoader pins tensors in lists and tuples by itself but leaves DGL graphs alone, so the
+    output is wrapped in an object that is not a sequence such that the DataLoader calls its pin_memory method. It is
+    iterated like the wrapped output.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __iter__(self):
+        return iter(self.batch)
+
+    def __getitem__(self, index):
+        return self.batch[index]
+
+    def __len__(self):
+        return len(self.batch)
+
+    def pin_memory(self):
+        return PinnedBatch(pin_collate_output(self.batch))
+
+
+class PinnedBatchCollate(object):
+    # wraps the output of a collate function in a PinnedBatch. Pinning itself must not happen in the collate function
+    # since that runs in the DataLoader workers if there are any
+
+    def __init__(self, collate_function):
+        self.collate_function = collate_function
+
+    def __call__(self, batch):
+        return PinnedBatch(self.collate_function(batch))
+
+
 class NoisedDistancesCollate(object):
     def __init__(self, std, num_noised):
         self.std = std
         self.num_noised = num_noised
+        self.generator = None
 
     def __call__(self, batch: List[Tuple]):
 
         graphs, graphs3d, *targets = map(list, zip(*batch))
         batched_graph = dgl.batch(graphs)
         batched_graph3d = dgl.batch(graphs3d)
-        graphs3d_noised = [batched_graph3d]
-        for i in range(self.num_noised):
-            copy_graph = copy.deepcopy(batched_graph3d)
-            copy_graph.edata['w'] += torch.randn_like(copy_graph.edata['w']) * self.std
-            graphs3d_noised.append(copy_graph)
-
-        batched_graph3d = dgl.batch(graphs3d_noised)
+        distances = batched_graph3d.edata['w']
+        if self.generator is None:
+            # created lazily such that every DataLoader worker gets its own generator, seeded with the worker seed
+            self.generator = torch.Generator(device=distances.device)
+            self.generator.manual_seed(torch.initial_seed())
+        # the first copy keeps the original distances, the other num_noised copies are noised with one RNG call
+        all_distances = distances.unsqueeze(0).repeat(self.num_noised + 1, *([1] * distances.dim()))
+        all_distances[1:] += torch.randn((self.num_noised,) + distances.shape, dtype=distances.dtype,
+                                         device=distances.device, generator=self.generator) * self.std
+        # batch the topology num_noised + 1 times in one go and assign all distances at once
+        batched_graph3d = dgl.batch([batched_graph3d] * (self.num_noised + 1))
+        batched_graph3d.edata['w'] = all_distances.view(-1, *distances.shape[1:])
 
         if targets:
-            return [batched_graph], [batched_graph3d], torch.stack(*targets).float()
-        else:
-            return [batched_graph], [batched_graph3d]
+            return [batched_graph], [batched_graph3d], torch.stack(targets[0]).float()
+        return [batched_graph], [batched_graph3d]
 
 
 def conformer_collate(batch: List[Tuple]):
@@ -176,6 +238,7 @@ class NoisedCoordinatesCollate(object):
     def __init__(self, std, num_noised):
         self.std = std
         self.num_noised = num_noised
+        self.generator = None
 
     def __call__(self, batch: List[Tuple]):
 
@@ -183,21 +246,29 @@ class NoisedCoordinatesCollate(object):
         batched_graph = dgl.batch(graphs)
         batched_graph3d = dgl.batch(graphs3d)
         graphs3d_noised = [batched_graph3d]
-        previous_distances = batched_graph3d.edata['w']
-        edges = batched_graph3d.all_edges()
+        src, dst = (edge_index.contiguous() for edge_index in batched_graph3d.all_edges())
+        coordinates = batched_graph3d.ndata['x']
+        if self.generator is None:
+            # created lazily such that every DataLoader worker gets its own generator, seeded with the worker seed
+            self.generator = torch.Generator(device=coordinates.device)
+            self.generator.manual_seed(torch.initial_seed())
+        # noise all copies with a single RNG call: [num_noised, n_nodes, 3]
+        noised_coordinates = coordinates.unsqueeze(0) + torch.randn(
+            (self.num_noised,) + coordinates.shape, dtype=coordinates.dtype, device=coordinates.device,
+            generator=self.generator) * self.std
+        diff = noised_coordinates.index_select(1, src) - noised_coordinates.index_select(1, dst)
+        distances = (diff * diff).sum(-1).sqrt_()  # [num_noised, n_edges]
         for i in range(self.num_noised):
-            copy_graph = copy.deepcopy(batched_graph3d)
-            copy_graph.ndata['x'] += torch.randn_like(copy_graph.ndata['x']) * self.std
-            distances = torch.norm(copy_graph.ndata['x'][edges[0]] - copy_graph.ndata['x'][edges[1]], p=2, dim=-1)
-            copy_graph.edata['w'] = distances[:, None]
+            copy_graph = batched_graph3d.clone()
+            copy_graph.ndata['x'] = noised_coordinates[i]
+            copy_graph.edata['w'] = distances[i].unsqueeze(1)
             graphs3d_noised.append(copy_graph)
 
         batched_graph3d = dgl.batch(graphs3d_noised)
 
         if targets:
-            return [batched_graph], [batched_graph3d], torch.stack(*targets).float()
-        else:
-            return [batched_graph], [batched_graph3d]
+            return [batched_graph], [batched_graph3d], torch.stack(targets[0]).float()
+        return [batched_graph], [batched_graph3d]
 
 
 class NodeDrop3dCollate(object):
@@ -207,14 +278,16 @@ class NodeDrop3dCollate(object):
     def __call__(self, batch: List[Tuple]):
         graphs, graphs3d = map(list, zip(*batch))
         device = graphs3d[0].device
-        for graph3d in graphs3d:
-            remove_number = torch.randint(low=0, high=self.num_drop, size=(1,))
-            if remove_number > 0:
-                remove_indices = torch.randint(low=0, high=graph3d.number_of_nodes(), size=(remove_number.data,),
-                                               device=device)
-                graph3d.remove_nodes(remove_indices)
         batched_graph = dgl.batch(graphs)
         batched_graph3d = dgl.batch(graphs3d)
+        # draw the number of dropped nodes and their indices for all graphs with one RNG call each and remove them
+        # from the batched graph at once, which keeps its batch information up to date
+        n_atoms = batched_graph3d.batch_num_nodes().cpu()
+        remove_numbers = torch.randint(low=0, high=self.num_drop, size=(len(graphs3d),))
+        remove_indices = torch.rand(int(remove_numbers.sum())) * torch.repeat_interleave(n_atoms, remove_numbers)
+        graph_offsets = torch.repeat_interleave(n_atoms.cumsum(0) - n_atoms, remove_numbers)
+        if len(remove_indices) > 0:
+            batched_graph3d.remove_nodes((remove_indices.long() + graph_offsets).to(device))
 
         return [batched_graph], [batched_graph3d]
 
@@ -251,7 +324,8 @@ class NodeDropCollate(object):
     def __call__(self, batch: List[Tuple]):
         graphs = [tuple[0] for tuple in batch]
         device = graphs[0].device
-        graphs2 = copy.deepcopy(graphs)
+        # remove_nodes replaces the graph structure of the copy, so sharing it via clone() is sufficient
+        graphs2 = [graph.clone() for graph in graphs]
 
         for graph in graphs:
             n_atoms = graph.num_nodes()
@@ -287,29 +361,55 @@ class NodeDrop2dCollate(object):
     def __call__(self, batch: List[Tuple]):
         graphs, graphs3d = map(list, zip(*batch))
         device = graphs3d[0].device
-        for graph in graphs:
-            remove_number = torch.randint(low=0, high=self.num_drop, size=(1,))
-            if remove_number > 0:
-                remove_indices = torch.randint(low=0, high=graph.number_of_nodes(), size=(remove_number.data,),
-                                               device=device)
-                graph.remove_nodes(remove_indices)
         batched_graph = dgl.batch(graphs)
         batched_graph3d = dgl.batch(graphs3d)
+        # draw the number of dropped nodes and their indices for all graphs with one RNG call each and remove them
+        # from the batched graph at once, which keeps its batch information up to date
+        n_atoms = batched_graph.batch_num_nodes().cpu()
+        remove_numbers = torch.randint(low=0, high=self.num_drop, size=(len(graphs),))
+        remove_indices = torch.rand(int(remove_numbers.sum())) * torch.repeat_interleave(n_atoms, remove_numbers)
+        graph_offsets = torch.repeat_interleave(n_atoms.cumsum(0) - n_atoms, remove_numbers)
+        if len(remove_indices) > 0:
+            batched_graph.remove_nodes((remove_indices.long() + graph_offsets).to(device))
 
         return [batched_graph], [batched_graph3d]
 
 
-def padded_collate(batch):
-    features = pad_sequence([item[0] for item in batch], batch_first=True)
-    targets = torch.stack([item[1] for item in batch])
+def pad_length_to_multiple(padded: torch.Tensor, multiple: int):
+    # zero pad the sequence dimension of a [batch_size, length, ...] tensor up to the next multiple of `multiple`
+    padding = -padded.shape[1] % multiple
+    if padding == 0:
+        return padded
+    return F.pad(padded, (0, 0) * (padded.dim() - 2) + (0, padding))
+
+
+def padded_collate(batch, pad_to_multiple: int = 1):
+    features, targets = [], []
+    for feature, target in batch:
+        features.append(feature)
+        targets.append(target)
+    n_atoms = sequence_lengths(features)
+    features = pad_length_to_multiple(pad_sequence(features, batch_first=True), pad_to_multiple)
+    targets = torch.stack(targets)
 
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    n_atoms = torch.tensor([len(item[0]) for item in batch])
-    mask = torch.arange(features.shape[1])[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, features.shape[1])  # [batch_size, n_atoms]
     return [features, mask], targets.float()
 
 
+def ragged_collate(batch):
+    """
+    Alternative to padded_collate for variable-length attention kernels: instead of padding and masking, the
+    features of all molecules are concatenated to [sum(n_atoms), feature_dim] and the sequence boundaries are given
+    by cu_seqlens = [0, n_atoms_1, n_atoms_1 + n_atoms_2, ...] of shape [batch_size + 1].
+    """
+    features, targets = map(list, zip(*batch))
+    n_atoms = sequence_lengths(features)
+    cu_seqlens = F.pad(n_atoms.cumsum(0), (1, 0)).to(torch.int32)
+    return [torch.cat(features, dim=0), cu_seqlens], torch.stack(targets).float()
+
+
 def egnn_padded_collate3d(batch):
     graphs, features, coordinates = map(list, zip(*batch))
     batched_graph = dgl.batch(graphs)
@@ -363,39 +463,60 @@ def egnn_padded_collate(batch):
     return [features, coordinates, edges, None, atom_mask, edge_mask, n_nodes], torch.stack(targets).float()
 
 
-def padded_collate_positional_encoding(batch):
-    features, pos_enc, targets = map(list, zip(*batch))
-    features = pad_sequence(features, batch_first=True)
-    pos_enc = pad_sequence(pos_enc, batch_first=True)
+def padded_collate_positional_encoding(batch, pad_to_multiple: int = 1):
+    features, pos_enc, targets = [], [], []
+    for feature, positional_encoding, target in batch:
+        features.append(feature)
+        pos_enc.append(positional_encoding)
+        targets.append(target)
+    n_atoms = sequence_lengths(features)
+    features = pad_length_to_multiple(pad_sequence(features, batch_first=True), pad_to_multiple)
+    pos_enc = pad_length_to_multiple(pad_sequence(pos_enc, batch_first=True), pad_to_multiple)
 
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    n_atoms = torch.tensor([len(item[0]) for item in batch])
-    mask = torch.arange(features.shape[1])[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, features.shape[1])  # [batch_size, n_atoms]
     return [features, pos_enc, mask], torch.stack(targets).float()
 
 
+class PaddedCollate(object):
+    """
+    padded_collate (or padded_collate_positional_encoding) with the sequence length rounded up to a multiple of
+    pad_to_multiple (8 for fp32/tf32, 16 for fp16) such that the matmuls of transformer models hit aligned
+    tensor core kernels. The additional positions are masked like any other padding.
+    """
+
+    def __init__(self, pad_to_multiple=8, positional_encoding=False):
+        self.pad_to_multiple = pad_to_multiple
+        self.positional_encoding = positional_encoding
+
+    def __call__(self, batch):
+        if self.positional_encoding:
+            return padded_collate_positional_encoding(batch, pad_to_multiple=self.pad_to_multiple)
+        return padded_collate(batch, pad_to_multiple=self.pad_to_multiple)
+
+
 def pna_transformer_collate(batch):
     graphs, features, pos_enc, targets = map(list, zip(*batch))
-    n_atoms = torch.tensor([len(feature) for feature in features])
+    n_atoms = sequence_lengths(features)
     features = pad_sequence(features, batch_first=True)
     pos_enc = pad_sequence(pos_enc, batch_first=True)
 
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    mask = torch.arange(features.shape[1])[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, features.shape[1])  # [batch_size, n_atoms]
     return [dgl.batch(graphs), features, pos_enc, mask], torch.stack(targets).float()
 
 
 def pna_transformer_collate_contrastive(batch):
     graphs, features, pos_enc, graphs3d = map(list, zip(*batch))
-    n_atoms = torch.tensor([len(feature) for feature in features])
+    n_atoms = sequence_lengths(features)
     features = pad_sequence(features, batch_first=True)
     pos_enc = pad_sequence(pos_enc, batch_first=True)
 
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    mask = torch.arange(features.shape[1])[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, features.shape[1])  # [batch_size, n_atoms]
     return [dgl.batch(graphs), features, pos_enc, mask], [dgl.batch(graphs3d)]
 
 
@@ -404,7 +525,7 @@ def molhiv_padded_collate(batch: List[Tuple]):
     features = pad_sequence([graph.ndata['feat'] for graph in graphs], batch_first=True)
 
     n_atoms = torch.tensor([graph.number_of_nodes() for graph in graphs])
-    mask = torch.arange(features.shape[1])[None, :] >= n_atoms[:, None]  # [batch_size, n_atoms]
+    mask = padding_mask(n_atoms, features.shape[1])  # [batch_size, n_atoms]
     return [features, None, mask], torch.stack(targets).float()
 
 
@@ -414,7 +535,25 @@ def padded_distances_collate(batch):
 
     # create mask corresponding to the zero padding used for the shorter sequences in the batch.
     # All values corresponding to padding are True and the rest is False.
-    n_dist = torch.tensor([len(dist) for dist in distances])
-    mask = torch.arange(padded.shape[1])[None, :] >= n_dist[:, None]  # [batch_size, n_atoms]
+    n_dist = sequence_lengths(distances)
+    mask = padding_mask(n_dist, padded.shape[1])  # [batch_size, n_atoms]
     batched_graph = dgl.batch(graphs)
     return batched_graph, padded, mask
+
+
+def packed_distances_collate(batch):
+    # like padded_distances_collate but without padding: the distances of all molecules are concatenated and the
+    # distances of molecule i are packed[offsets[i]:offsets[i + 1]]
+    graphs, distances = map(list, zip(*batch))
+    n_dist = sequence_lengths(distances)
+    offsets = F.pad(n_dist.cumsum(0), (1, 0))
+    batched_graph = dgl.batch(graphs)
+    return batched_graph, torch.cat(distances), offsets
+
+
+def packed_to_padded(packed: torch.Tensor, offsets: torch.Tensor):
+    # turns the output of packed_distances_collate into the padded distances and mask of padded_distances_collate
+    # for consumers that need them
+    lengths = offsets[1:] - offsets[:-1]
+    padded = pad_sequence(packed.split(lengths.tolist()), batch_first=True)
+    return padded, padding_mask(lengths, padded.shape[1])
@@ -1,12 +1,12 @@
+import multiprocessing as mp
 import os
 
 import torch
 import dgl
 import torch_geometric
-from ogb.utils.features import atom_to_feature_vector, bond_to_feature_vector, get_atom_feature_dims, \
-    get_bond_feature_dims
+from ogb.utils.features import atom_to_feature_vector, get_atom_feature_dims, get_bond_feature_dims, \
+    allowable_features, safe_index
 from rdkit import Chem
-from rdkit.Chem.rdmolops import GetAdjacencyMatrix
 from torch.utils.data import Dataset
 import numpy as np
 import pandas as pd
@@ -19,6 +19,98 @@ from commons.spherical_encoding import dist_emb
 hartree2eV = physical_constants['hartree-electron volt relationship'][0]
 
 
+def enum_to_feature_index(enum_type, allowable: list):
+    """
+    Lookup table from the integer values of an rdkit enum to the indices that ogb assigns to its members in the
+    allowable features. Members that are not allowable map to the last index like in safe_index.
+    """
+    table = np.full(max(enum_type.values) + 1, len(allowable) - 1, dtype=np.int64)
+    for value, member in enum_type.values.items():
+        table[value] = safe_index(allowable, str(member))
+    return table
+
+
+# with these the bond features of bond_to_feature_vector are computed for all bonds of a molecule at once
+bond_type_indices = enum_to_feature_index(Chem.rdchem.BondType, allowable_features['possible_bond_type_list'])
+bond_stereo_indices = enum_to_feature_index(Chem.rdchem.BondStereo, allowable_features['possible_bond_stereo_list'])
+
+
+def featurize_molecule(smiles: str):
+    """
+    Featurizes a single QM9 molecule given by its SMILES string. This is a module level function such that it can be
+    mapped over the molecules with a multiprocessing pool.
+
+    Returns
+    -------
+    atom features [n_atoms, n_atom_features], symmetric normalized Laplacian [n_atoms, n_atoms], edge index
+    [2, n_edges] in coo format and edge features [n_edges, n_bond_features] as numpy arrays. The Laplacians of all
+    molecules are decomposed together with laplacian_eigenpairs.
+    """
+    # get the molecule and add hydrogen bonds because they are not in the smiles representation
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    n_atoms = mol.GetNumAtoms()
+
+    atom_features = np.array([atom_to_feature_vector(atom) for atom in mol.GetAtoms()], dtype=np.int64)
+
+    # only the raw integer properties are read per bond, they are mapped to the ogb feature indices with lookup tables
+    bond_properties = np.array([(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(), int(bond.GetBondType()),
+                                 int(bond.GetStereo()), int(bond.GetIsConjugated())) for bond in mol.GetBonds()],
+                               dtype=np.int64).reshape(-1, 5)
+    bond_atoms = bond_properties[:, :2]
+    bond_features = np.stack([bond_type_indices[bond_properties[:, 2]], bond_stereo_indices[bond_properties[:, 3]],
+                              bond_properties[:, 4]], axis=1)
+    # Graph connectivity in COO format with shape [2, num_edges]. Every bond is added in both directions as the
+    # consecutive edges (i, j) and (j, i), which share the features of the bond
+    edge_index = np.stack([bond_atoms, bond_atoms[:, ::-1]], axis=1).reshape(-1, 2).T
+    edge_features = np.repeat(bond_features, 2, axis=0)
+
+    # I - N * L * N with L = D - A and N = D^-1/2 broadcast over the columns is A[i, j] / deg[j] (the diagonal cancels)
+    # so the Laplacian is filled directly from the edge list instead of building the dense D, L and I
+    src, dst = edge_index
+    degrees = np.bincount(dst, minlength=n_atoms).astype(np.float32)
+    L_sym = np.zeros((n_atoms, n_atoms), dtype=np.float32)
+    L_sym[src, dst] = 1 / degrees[dst]
+
+    return atom_features, L_sym, edge_index, edge_features
+
+
+def laplacian_eigenpairs(laplacians: list, max_freqs: int = 10, batch_size: int = 4096, device='cpu'):
+    """
+    Computes the eigenpairs of the Laplacians of many small molecules with batched calls to torch.linalg.eigh. The
+    Laplacians are padded to the size of the largest molecule with a diagonal that is larger than every eigenvalue of
+    a molecule (which are bounded by the maximum degree), such that the eigenpairs of the padding come last in the
+    ascending order of eigh and the eigenvectors of the molecule are zero on the padding.
+
+    Returns
+    -------
+    eigenvalues [n_molecules, max_freqs] and normalized eigenvectors [total_atoms, max_freqs] with the up to max_freqs
+    lowest frequencies in increasing order. They are padded with nan for molecules with less than max_freqs atoms.
+    """
+    n_atoms = torch.tensor([len(laplacian) for laplacian in laplacians], dtype=torch.long)
+    max_atoms = max(n_atoms.max().item(), max_freqs)
+    all_eig_vals = []
+    all_eig_vecs = []
+    for batch_start in range(0, len(laplacians), batch_size):
+        batch = laplacians[batch_start: batch_start + batch_size]
+        batch_n_atoms = n_atoms[batch_start: batch_start + batch_size]
+        padded = torch.diag_embed(torch.full((len(batch), max_atoms), 10.0))
+        for i, laplacian in enumerate(batch):
+            padded[i, :len(laplacian), :len(laplacian)] = torch.from_numpy(laplacian)
+        # only the lower triangle is read. eigh returns the eigenvalues in ascending order so no sorting is needed
+        eig_vals, eig_vecs = torch.linalg.eigh(padded.to(device), UPLO='L')
+        eig_vals, eig_vecs = eig_vals[:, :max_freqs].cpu(), eig_vecs[:, :, :max_freqs].cpu()
+
+        # only keep the rows of the atoms and mark the frequencies beyond the number of atoms as padding
+        eig_vecs = eig_vecs[torch.arange(max_atoms) < batch_n_atoms[:, None]]  # [n_atoms_in_batch, max_freqs]
+        eig_vecs = F.normalize(eig_vecs, p=2, dim=1, eps=1e-12)
+        padding_freqs = torch.arange(max_freqs) >= batch_n_atoms[:, None]  # [len(batch), max_freqs]
+        eig_vals[padding_freqs] = float('nan')
+        eig_vecs[padding_freqs.repeat_interleave(batch_n_atoms, dim=0)] = float('nan')
+        all_eig_vals.append(eig_vals)
+        all_eig_vecs.append(eig_vecs)
+    return torch.cat(all_eig_vals), torch.cat(all_eig_vecs)
+
+
 class QM9Dataset(Dataset):
     """The QM9 Dataset. It loads the specified types of data into memory. The processed data is saved in eV units.
 
@@ -87,6 +179,10 @@ class QM9Dataset(Dataset):
         The returned targets will be in the order specified by this list
     normalize: bool
         Whether or not the target (if they should be returned) are normalized to 0 mean and std 1
+    device:
+        Device of targets_mean, targets_std and eV2meV, which are used to denormalize the model outputs, and of the
+        eigendecomposition when the data is processed (if cuda is available). It does not affect the samples, which
+        are always returned on the cpu and moved to the device batch by batch by the trainer
     prefetch_graphs: bool
         Whether or not to load the dgl graphs into memory. This takes a bit more memory and the upfront computation but
         the graph creation does not have to be done during training which is nice because it takes a long time and can
@@ -95,10 +191,12 @@ class QM9Dataset(Dataset):
 
     def __init__(self, return_types: list = None,
                  target_tasks: list = None,
-                 normalize: bool = True, device='cuda:0', dist_embedding: bool = False, num_radial: int = 6, transform=None, **kwargs):
+                 normalize: bool = True, device='cuda:0', dist_embedding: bool = False, num_radial: int = 6, transform=None,
+                 prefetch_graphs: bool = False, **kwargs):
         self.qm9_directory = 'dataset/QM9'
-        self.processed_file = 'qm9_processed.pt'
+        self.processed_dir = 'qm9_processed'  # one .npy file per entry of the processed data dict
         self.distances_file = 'qm9_distances.pt'
+        self.graphs_file = 'qm9_graphs.bin'  # written into the processed dir such that it is regenerated along with it
         self.raw_qm9_file = 'qm9.csv'
         self.raw_spatial_data = 'qm9_eV.npz'
         self.atom_types = {'H': 0, 'C': 1, 'N': 2, 'O': 3, 'F': 4}
@@ -130,7 +228,8 @@ class QM9Dataset(Dataset):
                                 'g298_atom': hartree2eV}
 
         self.return_types: list = return_types
-
+        # the return types are fixed, so the methods that fetch them are looked up once instead of for every sample
+        self.fetchers = [self.get_fetcher(return_type) for return_type in self.return_types]
 
         if target_tasks == None or target_tasks == []:  # set default
             self.target_tasks = ['mu', 'alpha', 'homo', 'lumo', 'gap', 'r2', 'zpve', 'u0', 'u298', 'h298', 'g298', 'cv']
@@ -140,34 +239,54 @@ class QM9Dataset(Dataset):
             assert target_task in self.unit_conversion.keys()
 
         # load the data and get normalization values
-        if not os.path.exists(os.path.join(self.qm9_directory, 'processed', self.processed_file)):
+        if not os.path.exists(os.path.join(self.qm9_directory, 'processed', self.processed_dir)):
             self.process()
-        data_dict = torch.load(os.path.join(self.qm9_directory, 'processed', self.processed_file))
+        data_dict = self.load_processed(os.path.join(self.qm9_directory, 'processed', self.processed_dir))
 
+        # the features are stored as int8 and only converted to long for the embedding layers when they are sliced
         self.features_tensor = data_dict['atom_features']
 
         self.e_features_tensor = data_dict['edge_features']
+        # kept on the cpu like the rest of the sample data
+        self.bond_padding_indices = torch.tensor(get_bond_feature_dims(), dtype=torch.long)[None, :]
         self.coordinates = data_dict['coordinates']
         self.edge_indices = data_dict['edge_indices']
 
         self.meta_dict = {k: data_dict[k] for k in ('mol_id', 'edge_slices', 'atom_slices', 'n_atoms')}
+        # plain python ints for the per sample slicing in __getitem__ to avoid indexing tensors
+        self.edge_slices = self.meta_dict['edge_slices'].tolist()
+        self.atom_slices = self.meta_dict['atom_slices'].tolist()
+        self.n_atoms = self.meta_dict['n_atoms'].tolist()
 
         if 'san_graph' in self.return_types or 'positional_encoding' in self.return_types:
-            self.eig_vals = data_dict['eig_vals']
-            self.eig_vecs = data_dict['eig_vecs']
+            # the eigenvalues of each molecule are repeated for its atoms once here instead of for every sample
+            atom_mol = torch.repeat_interleave(torch.arange(len(self.n_atoms)), self.meta_dict['n_atoms'])
+            self.pos_enc_base = torch.stack([data_dict['eig_vals'][atom_mol], data_dict['eig_vecs']], dim=-1)
+
+        if 'complete_graph' in self.return_types:
+            self.complete_edge_features = data_dict['complete_edge_features']
+            self.complete_edge_slices = data_dict['complete_edge_slices'].tolist()
 
         if 'smiles' in self.return_types:
-            self.smiles = pd.read_csv(os.path.join(self.qm9_directory, self.raw_qm9_file))['smiles']
+            # only the smiles column is parsed and kept as a list such that it can be indexed by the mol_id directly
+            self.smiles = pd.read_csv(os.path.join(self.qm9_directory, self.raw_qm9_file),
+                                      usecols=['smiles'])['smiles'].tolist()
 
         self.dgl_graphs = {}
-        self.pairwise = {}  # for memoization
-        self.complete_graphs = {}
+        # the complete graph edges only depend on the number of atoms so they are built upfront
+        self.pairwise = {n_atoms: self.build_pairwise(n_atoms)
+                         for n_atoms in set(self.n_atoms)}
         self.mol_complete_graphs = {}
         self.pairwise_distances = {}
+        # all return types that are built from the cached molecular graphs of get_graph
+        graph_return_types = ['dgl_graph', 'se3Transformer_graph', 'se3Transformer_graph3d']
+        if prefetch_graphs and any(return_type in self.return_types for return_type in graph_return_types):
+            self.prefetch_graphs()
 
         self.avg_degree = data_dict['avg_degree']
         # indices of the tasks that should be retrieved
-        self.task_indices = torch.tensor([list(self.unit_conversion.keys()).index(task) for task in self.target_tasks])
+        task_to_index = {task: index for index, task in enumerate(self.unit_conversion.keys())}
+        self.task_indices = torch.tensor([task_to_index[task] for task in self.target_tasks])
         # select targets in the order specified by the target_tasks argument
 
         self.targets = data_dict['targets'].index_select(dim=1, index=self.task_indices)  # [130831, n_tasks]
@@ -179,12 +298,11 @@ class QM9Dataset(Dataset):
         self.targets_mean = self.targets_mean.to(device)
         self.targets_std = self.targets_std.to(device)
         # get a tensor that is 1000 for all targets that are energies and 1.0 for all other ones
-        self.eV2meV = torch.tensor(
-            [1.0 if list(self.unit_conversion.values())[task_index] == 1.0 else 1000 for task_index in
-             self.task_indices]).to(self.device)  # [n_tasks]
+        conversion_factors = torch.tensor(list(self.unit_conversion.values()))[self.task_indices]
+        self.eV2meV = torch.where(conversion_factors == 1.0, 1.0, 1000.0).to(self.device)  # [n_tasks]
         ic(self.eV2meV)
         ic(self.targets.std())
-        self.dist_embedder = dist_emb(num_radial=6).to(device)
+        self.dist_embedder = dist_emb(num_radial=6)
         self.dist_embedding = dist_embedding
 
     def __len__(self):
@@ -201,179 +319,221 @@ class QM9Dataset(Dataset):
         -------
         tuple of all data specified via the return_types parameter of the constructor
         """
-        data = []
-        e_start = self.meta_dict['edge_slices'][idx].item()
-        e_end = self.meta_dict['edge_slices'][idx + 1].item()
-        start = self.meta_dict['atom_slices'][idx].item()
-        n_atoms = self.meta_dict['n_atoms'][idx].item()
-
-        for return_type in self.return_types:
-            data.append(self.data_by_type(idx, return_type, e_start, e_end, start, n_atoms))
-        return tuple(data)
+        e_start = self.edge_slices[idx]
+        e_end = self.edge_slices[idx + 1]
+        start = self.atom_slices[idx]
+        n_atoms = self.n_atoms[idx]
+
+        return tuple(fetcher(idx, e_start, e_end, start, n_atoms) for fetcher in self.fetchers)
+
+    @staticmethod
+    def build_pairwise(n_atoms):
+        arange = torch.arange(n_atoms)
+        src = torch.repeat_interleave(arange, n_atoms)
+        dst = arange.repeat(n_atoms)
+        no_self_loops = src != dst
+        return src[no_self_loops], dst[no_self_loops]
+
+    @staticmethod
+    def complete_edge_ids(src, dst, n_atoms):
+        # edge ids of the edges (src, dst) in the complete graph of build_pairwise: every source atom has n_atoms - 1
+        # outgoing edges, and the self loop (src, src) is skipped
+        return src * (n_atoms - 1) + dst - (dst > src).long()
+
+    @staticmethod
+    def build_complete_edge_features(n_atoms, edge_slices, edge_indices, edge_features):
+        # edge features of all complete graphs without self loops in the order of build_pairwise. Virtual edges get
+        # the padding index of every bond feature
+        n_complete_edges = n_atoms * (n_atoms - 1)
+        complete_edge_slices = F.pad(n_complete_edges.cumsum(0), (1, 0))
+        complete_edge_features = torch.tensor(get_bond_feature_dims(), dtype=torch.int8).repeat(
+            complete_edge_slices[-1].item(), 1)
+        # position of every bond within the complete edges of its molecule
+        bond_mol = torch.repeat_interleave(torch.arange(len(n_atoms)), edge_slices[1:] - edge_slices[:-1])
+        src, dst = edge_indices
+        bond_positions = complete_edge_slices[bond_mol] + QM9Dataset.complete_edge_ids(src, dst, n_atoms[bond_mol])
+        complete_edge_features[bond_positions] = edge_features
+        return complete_edge_features, complete_edge_slices
+
+    def prefetch_graphs(self):
+        # the molecular graphs are built once and serialized, such that later runs only have to load them
+        graphs_path = os.path.join(self.qm9_directory, 'processed', self.processed_dir, self.graphs_file)
+        if os.path.exists(graphs_path):
+            graphs, _ = dgl.load_graphs(graphs_path)
+            self.dgl_graphs = dict(enumerate(graphs))
+        else:
+            for idx in tqdm(range(len(self))):
+                e_start, e_end = self.edge_slices[idx: idx + 2]
+                self.get_graph(idx, e_start, e_end, self.n_atoms[idx], self.atom_slices[idx])
+            dgl.save_graphs(graphs_path, [self.dgl_graphs[idx] for idx in range(len(self))])
 
     def get_pairwise(self, n_atoms):
-        if n_atoms in self.pairwise:
-            src, dst = self.pairwise[n_atoms]
-            return src.to(self.device), dst.to(self.device)
-        else:
-            arange = torch.arange(n_atoms, device=self.device)
-            src = torch.repeat_interleave(arange, n_atoms - 1)
-            dst = torch.cat([torch.cat([arange[:idx], arange[idx + 1:]]) for idx in range(n_atoms)])  # no self loops
-            self.pairwise[n_atoms] = (src.to('cpu'), dst.to('cpu'))
-            return src, dst
+        if n_atoms not in self.pairwise:
+            self.pairwise[n_atoms] = self.build_pairwise(n_atoms)
+        return self.pairwise[n_atoms]
 
     def get_graph(self, idx, e_start, e_end, n_atoms, start):
-        if idx in self.dgl_graphs:
-            return self.dgl_graphs[idx].to(self.device)
-        else:
+        if idx not in self.dgl_graphs:
             edge_indices = self.edge_indices[:, e_start: e_end]
-            g = dgl.graph((edge_indices[0], edge_indices[1]), num_nodes=n_atoms, device=self.device)
-            g.ndata['feat'] = self.features_tensor[start: start + n_atoms].to(self.device)
-            g.ndata['x'] = self.coordinates[start: start + n_atoms].to(self.device)
-            g.edata['feat'] = self.e_features_tensor[e_start: e_end].to(self.device)
-            self.dgl_graphs[idx] = g.to('cpu')
-            return g
+            g = dgl.graph((edge_indices[0], edge_indices[1]), num_nodes=n_atoms)
+            g.ndata['feat'] = self.features_tensor[start: start + n_atoms].long()
+            g.ndata['x'] = self.coordinates[start: start + n_atoms]
+            g.edata['feat'] = self.e_features_tensor[e_start: e_end].long()
+            self.dgl_graphs[idx] = g
+        # the fetchers add edge data and the node drop collates remove nodes in place, which must not change the cached
+        # graph. The clone shares the feature tensors, so it is cheap
+        return self.dgl_graphs[idx].clone()
 
     def get_complete_graph(self, idx, n_atoms, start):
-        if idx in self.complete_graphs:
-            return self.complete_graphs[idx].to(self.device)
-        else:
-            src, dst = self.get_pairwise(n_atoms)
-            g = dgl.graph((src, dst), device=self.device)
-            g.ndata['feat'] = self.features_tensor[start: start + n_atoms].to(self.device)
-            g.ndata['x'] = self.coordinates[start: start + n_atoms].to(self.device)
-            g.edata['d'] = torch.norm(g.ndata['x'][g.edges()[0]] - g.ndata['x'][g.edges()[1]], p=2, dim=-1).unsqueeze(
-                -1).detach()
-            self.complete_graphs[idx] = g.to('cpu')
-            return g
+        # not memoized per molecule since that keeps a dgl graph with n_atoms^2 edges alive for every molecule. The
+        # skeleton is shared by all molecules with the same number of atoms, so building the graph is cheap
+        src, dst = self.get_pairwise(n_atoms)
+        g = dgl.graph((src, dst), num_nodes=n_atoms)
+        g.ndata['feat'] = self.features_tensor[start: start + n_atoms].long()
+        coords = self.coordinates[start: start + n_atoms]
+        g.ndata['x'] = coords
+        g.edata['d'] = torch.linalg.vector_norm(coords[src] - coords[dst], dim=-1, keepdim=True).detach()
+        return g
 
     def get_mol_complete_graph(self, idx, e_start, e_end, n_atoms, start):
-        if idx in self.mol_complete_graphs:
-            return self.mol_complete_graphs[idx].to(self.device)
-        else:
+        if idx not in self.mol_complete_graphs:
             edge_indices = self.edge_indices[:, e_start: e_end]
             src, dst = self.get_pairwise(n_atoms)
             g = dgl.heterograph({('atom', 'bond', 'atom'): (edge_indices[0], edge_indices[1]),
-                                 ('atom', 'complete', 'atom'): (src, dst)}, device=self.device)
-            g.ndata['feat'] = self.features_tensor[start: start + n_atoms].to(self.device)
-            g.ndata['x'] = self.coordinates[start: start + n_atoms].to(self.device)
+                                 ('atom', 'complete', 'atom'): (src, dst)})
+            g.ndata['feat'] = self.features_tensor[start: start + n_atoms].long()
+            g.ndata['x'] = self.coordinates[start: start + n_atoms]
             self.mol_complete_graphs[idx] = g
-            return g
+        # cloned for the same reason as in get_graph
+        return self.mol_complete_graphs[idx].clone()
+
+    def get_positional_encoding(self, idx, n_atoms, start):
+        pos_enc_base = self.pos_enc_base[start: start + n_atoms]  # [n_atoms, max_freqs, 2]
+        # randomly flip the sign of every eigenvector since the eigenvectors are only defined up to their sign
+        sign_flip = torch.randint(0, 2, (pos_enc_base.shape[1],), dtype=torch.float32) * 2 - 1
+        return pos_enc_base * torch.stack([torch.ones_like(sign_flip), sign_flip], dim=-1)
 
     def data_by_type(self, idx, return_type, e_start, e_end, start, n_atoms):
-        if return_type == 'dgl_graph':
-            return self.get_graph(idx, e_start, e_end, n_atoms, start)
-        elif return_type == 'complete_graph':  # complete graph without self loops
-            g = self.get_complete_graph(idx, n_atoms, start)
-
-            # set edge features with padding for virtual edges
-            bond_features = self.e_features_tensor[e_start: e_end].to(self.device)
-            # TODO: replace with -1 padding
-            e_features = self.bond_padding_indices.expand(n_atoms * n_atoms, -1)
-            edge_indices = self.edge_indices[:, e_start: e_end].to(self.device)
-            bond_indices = edge_indices[0] * n_atoms + edge_indices[1]
-            # overwrite the bond features
-            e_features = e_features.scatter(dim=0, index=bond_indices[:, None].expand(-1, bond_features.shape[1]),
-                                            src=bond_features)
-            src, dst = self.get_pairwise(n_atoms)
-            g.edata['feat'] = e_features[src * n_atoms + dst]
-            if self.dist_embedding:
-                g.edata['d_rbf'] = self.dist_embedder(g.edata['feat']).to(self.device)
-            return g
-        elif return_type == 'complete_graph3d':
-            g = self.get_complete_graph(idx, n_atoms, start)
-            if self.dist_embedding:
-                g.edata['d_rbf'] = self.dist_embedder(g.edata['feat']).to(self.device)
-            return g
-        if return_type == 'mol_complete_graph':
-            g = self.get_mol_complete_graph(idx, e_start, e_end, n_atoms,start)
-            if self.e_features_tensor != None:
-                g.edges['bond'].data['feat'] = self.e_features_tensor[e_start: e_end].to(self.device)
-            return g
-        elif return_type == 'san_graph':
-            g = self.get_complete_graph(idx, n_atoms,start).to(self.device)
-            eig_vals = self.eig_vals[idx].to(self.device)
-            sign_flip = torch.rand(eig_vals.shape[0], device=self.device)
-            sign_flip[sign_flip >= 0.5] = 1.0
-            sign_flip[sign_flip < 0.5] = -1.0
-            eig_vecs = self.eig_vecs[start: start + n_atoms].to(self.device) * sign_flip.unsqueeze(0)
-            eig_vals = eig_vals.unsqueeze(0).repeat(n_atoms, 1)
-            g.ndata['pos_enc'] = torch.stack([eig_vals, eig_vecs], dim=-1)
-            if self.e_features_tensor != None:
-                e_features = self.e_features_tensor[e_start: e_end].to(self.device).float()
-                g.edata['feat'] = torch.zeros(g.number_of_edges(), e_features.shape[1], dtype=torch.float32,
-                                              device=self.device)
-                g.edata['real'] = torch.zeros(g.number_of_edges(), dtype=torch.long, device=self.device)
-                edge_indices = self.edge_indices[:, e_start: e_end].to(self.device)
-                g.edges[edge_indices[0], edge_indices[1]].data['feat'] = e_features
-                g.edges[edge_indices[0], edge_indices[1]].data['real'] = torch.ones(e_features.shape[0],
-                                                                                    dtype=torch.long,
-                                                                                    device=self.device)  # This indicates real edges
-            return g
-        elif return_type == 'se3Transformer_graph' or return_type == 'se3Transformer_graph3d':
-            g = self.get_graph(idx, e_start, e_end, n_atoms,start)
-            g.edata['d'] = torch.norm(g.ndata['x'][g.edges()[0]] - g.ndata['x'][g.edges()[1]], p=2, dim=-1).unsqueeze(
-                -1)
-            if self.e_features_tensor != None and return_type == 'se3Transformer_graph':
-                g.edata['feat'] = self.e_features_tensor[e_start: e_end].to(self.device)
-            return g
-        elif return_type == 'padded_e_features':
-            bond_features = self.e_features_tensor[e_start: e_end].to(self.device)
-            # TODO: replace with -1 padding
-            e_features = self.bond_padding_indices.expand(n_atoms * n_atoms, -1)
-            edge_indices = self.edge_indices[:, e_start: e_end].to(self.device)
-            bond_indices = edge_indices[0] * n_atoms + edge_indices[1]
-            # overwrite the bond features
-            return e_features.scatter(dim=0, index=bond_indices[:, None].expand(-1, bond_features.shape[1]),
-                                      src=bond_features)
-        elif return_type == 'pytorch_geometric_smp_graph':
-            R_i = self.coordinates[start: start + n_atoms].to(self.device)
-            z_i = self.features_tensor[start: start + n_atoms].to(self.device)
-            return torch_geometric.data.Data(pos=R_i, z=z_i)
-        elif return_type == 'pytorch_geometric_graph':
-            edge_features = self.e_features_tensor[e_start: e_end].to(self.device)
-            edge_indices = self.edge_indices[:, e_start: e_end].to(self.device)
-            R_i = self.coordinates[start: start + n_atoms].to(self.device)
-            z_i = self.features_tensor[start: start + n_atoms].to(self.device)
-            return torch_geometric.data.Data(pos=R_i, z=z_i, edge_attr=edge_features, edge_index=edge_indices)
-        elif return_type == 'pairwise_indices':
-            src, dst = self.get_pairwise(n_atoms)
-            return torch.stack([src, dst], dim=0)
-        elif return_type == 'pairwise_distances':
-            if idx in self.pairwise_distances:
-                return self.pairwise_distances[idx].to(self.device)
-            else:
-                src, dst = self.get_pairwise(n_atoms)
-                coords = self.coordinates[start: start + n_atoms].to(self.device)
-                distances = torch.norm(coords[src] - coords[dst], p=2, dim=-1).unsqueeze(-1).detach()
-                self.pairwise_distances[idx] = distances.to('cpu')
-                return distances
-        elif return_type == 'raw_features':
-            return self.features_tensor[start: start + n_atoms].to(self.device)
-        elif return_type == 'constant_ones':
-            return torch.ones_like(self.features_tensor[start: start + n_atoms], device=self.device)
-        elif return_type == 'n_atoms':
-            return self.meta_dict['n_atoms'][n_atoms]
-        elif return_type == 'coordinates':
-            return self.coordinates[start: start + n_atoms].to(self.device)
-        elif return_type == 'positional_encoding':
-            eig_vals = self.eig_vals[idx].to(self.device)
-            sign_flip = torch.rand(eig_vals.shape[0], device=self.device)
-            sign_flip[sign_flip >= 0.5] = 1.0
-            sign_flip[sign_flip < 0.5] = -1.0
-            eig_vecs = self.eig_vecs[start: start + n_atoms].to(self.device) * sign_flip.unsqueeze(0)
-            eig_vals = eig_vals.unsqueeze(0).repeat(n_atoms, 1)
-            return torch.stack([eig_vals, eig_vecs], dim=-1)
-        elif return_type == 'mol_id':
-            return self.meta_dict['mol_id'][idx]
-        elif return_type == 'targets':
-            return self.targets[idx]
-        elif return_type == 'edge_indices':
-            return self.meta_dict['edge_indices'][:, e_start: e_end]
-        elif return_type == 'smiles':
-            return self.smiles[self.meta_dict['mol_id'][idx]]
-        else:
+        return self.get_fetcher(return_type)(idx, e_start, e_end, start, n_atoms)
+
+    def get_fetcher(self, return_type):
+        # every return type has a fetch_<return_type> method with the same signature
+        fetcher = getattr(self, 'fetch_' + return_type, None)
+        if fetcher is None:
             raise Exception(f'return type not supported: ', return_type)
+        return fetcher
+
+    def fetch_dgl_graph(self, idx, e_start, e_end, start, n_atoms):
+        return self.get_graph(idx, e_start, e_end, n_atoms, start)
+
+    def fetch_complete_graph(self, idx, e_start, e_end, start, n_atoms):  # complete graph without self loops
+        g = self.get_complete_graph(idx, n_atoms, start)
+        # edge features with padding for virtual edges are precomputed in the order of the complete graph edges
+        ce_start, ce_end = self.complete_edge_slices[idx: idx + 2]
+        g.edata['feat'] = self.complete_edge_features[ce_start: ce_end].long()
+        if self.dist_embedding:
+            g.edata['d_rbf'] = self.dist_embedder(g.edata['feat'])
+        return g
+
+    def fetch_complete_graph3d(self, idx, e_start, e_end, start, n_atoms):
+        g = self.get_complete_graph(idx, n_atoms, start)
+        if self.dist_embedding:
+            g.edata['d_rbf'] = self.dist_embedder(g.edata['feat'])
+        return g
+
+    def fetch_mol_complete_graph(self, idx, e_start, e_end, start, n_atoms):
+        g = self.get_mol_complete_graph(idx, e_start, e_end, n_atoms, start)
+        if self.e_features_tensor != None:
+            g.edges['bond'].data['feat'] = self.e_features_tensor[e_start: e_end].long()
+        return g
+
+    def fetch_san_graph(self, idx, e_start, e_end, start, n_atoms):
+        g = self.get_complete_graph(idx, n_atoms, start)
+        g.ndata['pos_enc'] = self.get_positional_encoding(idx, n_atoms, start)
+        if self.e_features_tensor != None:
+            e_features = self.e_features_tensor[e_start: e_end].float()
+            edge_indices = self.edge_indices[:, e_start: e_end]
+            bond_eids = self.complete_edge_ids(edge_indices[0], edge_indices[1], n_atoms)
+            feat = torch.zeros(g.number_of_edges(), e_features.shape[1], dtype=torch.float32)
+            feat[bond_eids] = e_features
+            real = torch.zeros(g.number_of_edges(), dtype=torch.long)
+            real[bond_eids] = 1  # This indicates real edges
+            g.edata['feat'] = feat
+            g.edata['real'] = real
+        return g
+
+    def fetch_se3Transformer_graph3d(self, idx, e_start, e_end, start, n_atoms):
+        g = self.get_graph(idx, e_start, e_end, n_atoms, start)  # a copy, so d is not written into the cached graph
+        src, dst = g.edges()
+        g.edata['d'] = torch.linalg.vector_norm(g.ndata['x'][src] - g.ndata['x'][dst], dim=-1, keepdim=True)
+        return g
+
+    def fetch_se3Transformer_graph(self, idx, e_start, e_end, start, n_atoms):
+        g = self.fetch_se3Transformer_graph3d(idx, e_start, e_end, start, n_atoms)
+        if self.e_features_tensor != None:
+            g.edata['feat'] = self.e_features_tensor[e_start: e_end].long()
+        return g
+
+    def fetch_padded_e_features(self, idx, e_start, e_end, start, n_atoms):
+        # TODO: replace with -1 padding
+        e_features = self.bond_padding_indices.repeat(n_atoms * n_atoms, 1)
+        edge_indices = self.edge_indices[:, e_start: e_end]
+        # overwrite the bond features
+        e_features[edge_indices[0] * n_atoms + edge_indices[1]] = self.e_features_tensor[e_start: e_end].long()
+        return e_features
+
+    def fetch_pytorch_geometric_smp_graph(self, idx, e_start, e_end, start, n_atoms):
+        R_i = self.coordinates[start: start + n_atoms]
+        z_i = self.features_tensor[start: start + n_atoms].long()
+        return torch_geometric.data.Data(pos=R_i, z=z_i)
+
+    def fetch_pytorch_geometric_graph(self, idx, e_start, e_end, start, n_atoms):
+        edge_features = self.e_features_tensor[e_start: e_end].long()
+        edge_indices = self.edge_indices[:, e_start: e_end]
+        R_i = self.coordinates[start: start + n_atoms]
+        z_i = self.features_tensor[start: start + n_atoms].long()
+        return torch_geometric.data.Data(pos=R_i, z=z_i, edge_attr=edge_features, edge_index=edge_indices)
+
+    def fetch_pairwise_indices(self, idx, e_start, e_end, start, n_atoms):
+        src, dst = self.get_pairwise(n_atoms)
+        return torch.stack([src, dst], dim=0)
+
+    def fetch_pairwise_distances(self, idx, e_start, e_end, start, n_atoms):
+        if idx in self.pairwise_distances:
+            return self.pairwise_distances[idx]
+        else:
+            src, dst = self.get_pairwise(n_atoms)
+            coords = self.coordinates[start: start + n_atoms]
+            distances = torch.linalg.vector_norm(coords[src] - coords[dst], dim=-1, keepdim=True).detach()
+            self.pairwise_distances[idx] = distances
+            return distances
+
+    def fetch_raw_features(self, idx, e_start, e_end, start, n_atoms):
+        return self.features_tensor[start: start + n_atoms].long()
+
+    def fetch_constant_ones(self, idx, e_start, e_end, start, n_atoms):
+        return torch.ones_like(self.features_tensor[start: start + n_atoms], dtype=torch.long)
+
+    def fetch_n_atoms(self, idx, e_start, e_end, start, n_atoms):
+        return self.meta_dict['n_atoms'][n_atoms]
+
+    def fetch_coordinates(self, idx, e_start, e_end, start, n_atoms):
+        return self.coordinates[start: start + n_atoms]
+
+    def fetch_positional_encoding(self, idx, e_start, e_end, start, n_atoms):
+        return self.get_positional_encoding(idx, n_atoms, start)
+
+    def fetch_mol_id(self, idx, e_start, e_end, start, n_atoms):
+        return self.meta_dict['mol_id'][idx]
+
+    def fetch_targets(self, idx, e_start, e_end, start, n_atoms):
+        return self.targets[idx]
+
+    def fetch_edge_indices(self, idx, e_start, e_end, start, n_atoms):
+        return self.meta_dict['edge_indices'][:, e_start: e_end]
+
+    def fetch_smiles(self, idx, e_start, e_end, start, n_atoms):
+        return self.smiles[self.meta_dict['mol_id'][idx]]
 
     def process(self):
         print('processing data from ({}) and saving it to ({})'.format(self.qm9_directory,
@@ -381,101 +541,89 @@ class QM9Dataset(Dataset):
 
         # load qm9 data with spatial coordinates
         data_qm9 = dict(np.load(os.path.join(self.qm9_directory, self.raw_spatial_data), allow_pickle=True))
-        coordinates = torch.tensor(data_qm9['R'], dtype=torch.float)
+        coordinates = torch.from_numpy(data_qm9['R'].astype(np.float32))
         # Read the QM9 data with SMILES information
         molecules_df = pd.read_csv(os.path.join(self.qm9_directory, self.raw_qm9_file))
 
-        atom_slices = [0]
-        edge_slices = [0]
-        total_eigvecs = []
-        total_eigvals = []
-        all_atom_features = []
+        # the atom counts are known upfront and the edge counts are collected, the slices are their cumulative sums
+        n_atoms = torch.from_numpy(data_qm9['N'].astype(np.int64))
+        atom_slices = F.pad(n_atoms.cumsum(0), (1, 0))
+        n_edges = []
+        laplacians = []
+        # filled molecule by molecule and only converted to a tensor once at the end. All feature indices are smaller
+        # than 128 such that int8 is enough to store them
+        all_atom_features = np.empty((atom_slices[-1].item(), len(get_atom_feature_dims())), dtype=np.int8)
         all_edge_features = []
         edge_indices = []  # edges of each molecule in coo format
-        targets = []  # the 19 properties that should be predicted for the QM9 dataset
-        total_atoms = 0
-        total_edges = 0
-        avg_degree = 0  # average degree in the dataset
-        # go through all molecules in the npz file
-        for mol_idx, n_atoms in tqdm(enumerate(data_qm9['N'][:29])):
-            # get the molecule using the smiles representation from the csv file
-            mol = Chem.MolFromSmiles(molecules_df['smiles'][data_qm9['id'][mol_idx]])
-            # add hydrogen bonds to molecule because they are not in the smiles representation
-            mol = Chem.AddHs(mol)
-
-            atom_features_list = []
-            for atom in mol.GetAtoms():
-                atom_features_list.append(atom_to_feature_vector(atom))
-            all_atom_features.append(torch.tensor(atom_features_list, dtype=torch.long))
-
-            adj = GetAdjacencyMatrix(mol, useBO=False, force=True)
-            max_freqs = 10
-            adj = torch.tensor(adj).float()
-            D = torch.diag(adj.sum(dim=0))
-            L = D - adj
-            N = adj.sum(dim=0) ** -0.5
-            L_sym = torch.eye(n_atoms) - N * L * N
-            eig_vals, eig_vecs =torch.linalg.eigh(L_sym)
-            idx = eig_vals.argsort()[0: max_freqs]  # Keep up to the maximum desired number of frequencies
-            eig_vals, eig_vecs = eig_vals[idx], eig_vecs[:, idx]
-
-            # Sort, normalize and pad EigenVectors
-            eig_vecs = eig_vecs[:, eig_vals.argsort()]  # increasing order
-            eig_vecs = F.normalize(eig_vecs, p=2, dim=1, eps=1e-12, out=None)
-            if n_atoms < max_freqs:
-                eig_vecs = F.pad(eig_vecs, (0, max_freqs - n_atoms), value=float('nan'))
-                eig_vals = F.pad(eig_vals, (0, max_freqs - n_atoms), value=float('nan'))
-
-            total_eigvecs.append(eig_vecs)
-            total_eigvals.append(eig_vals.unsqueeze(0))
-
-            edges_list = []
-            edge_features_list = []
-            for bond in mol.GetBonds():
-                i = bond.GetBeginAtomIdx()
-                j = bond.GetEndAtomIdx()
-                edge_feature = bond_to_feature_vector(bond)
-
-                # add edges in both directions
-                edges_list.append((i, j))
-                edge_features_list.append(edge_feature)
-                edges_list.append((j, i))
-                edge_features_list.append(edge_feature)
-            # Graph connectivity in COO format with shape [2, num_edges]
-            edge_index = torch.tensor(edges_list, dtype=torch.long).T
-            edge_features = torch.tensor(edge_features_list, dtype=torch.long)
-
-            avg_degree += (len(edges_list) / 2) / n_atoms
-
-            # get all 19 attributes that should be predicted, so we drop the first two entries (name and smiles)
-            target = torch.tensor(molecules_df.iloc[data_qm9['id'][mol_idx]][2:], dtype=torch.float)
-            targets.append(target)
-            edge_indices.append(edge_index)
-            all_edge_features.append(edge_features)
-
-            total_edges += len(edges_list)
-            total_atoms += n_atoms
-            edge_slices.append(total_edges)
-            atom_slices.append(total_atoms)
-        # convert targets to eV units
-        u = torch.stack(targets)[:, list(self.unit_conversion.keys()).index('u0')]
+        # featurize the molecules in parallel. imap keeps the order of the npz file which the slices rely on
+        smiles = molecules_df['smiles'].loc[data_qm9['id']].tolist()
+        with mp.Pool(os.cpu_count()) as pool:
+            featurized = pool.imap(featurize_molecule, smiles, chunksize=256)
+            for mol_idx, (atom_features, laplacian, edge_index, edge_features) in tqdm(
+                    enumerate(featurized), total=len(smiles)):
+                start, end = atom_slices[mol_idx: mol_idx + 2].tolist()
+                all_atom_features[start: end] = atom_features
+                laplacians.append(laplacian)
+                edge_indices.append(edge_index)
+                all_edge_features.append(edge_features)
+                n_edges.append(edge_index.shape[1])
+        # the eigendecomposition is batched over the molecules and runs on the gpu if there is one
+        eig_vals, eig_vecs = laplacian_eigenpairs(laplacians,
+                                                  device=self.device if torch.cuda.is_available() else 'cpu')
+        n_edges = torch.from_numpy(np.array(n_edges, dtype=np.int64))
+        edge_slices = F.pad(n_edges.cumsum(0), (1, 0))
+        avg_degree = ((n_edges.double() / 2) / n_atoms).mean().item()  # average degree in the dataset
+        # get all 19 attributes that should be predicted, so we drop the first two columns (name and smiles)
+        targets = torch.from_numpy(molecules_df.iloc[data_qm9['id'], 2:].to_numpy(dtype=np.float32))
+        u = targets[:, list(self.unit_conversion.keys()).index('u0')]
         ic(u.mean())
-        targets = torch.stack(targets) * torch.tensor(list(self.unit_conversion.values()))[None, :]
+        # convert targets to eV units
+        targets = targets * torch.tensor(list(self.unit_conversion.values()))[None, :]
+        edge_indices = torch.from_numpy(np.concatenate(edge_indices, axis=1))
+        edge_features = torch.from_numpy(np.concatenate(all_edge_features, axis=0).astype(np.int8))
+        complete_edge_features, complete_edge_slices = self.build_complete_edge_features(n_atoms, edge_slices,
+                                                                                         edge_indices, edge_features)
         data_dict = {'mol_id': data_qm9['id'],
-                     'n_atoms': torch.tensor(data_qm9['N'], dtype=torch.long),
-                     'atom_slices': torch.tensor(atom_slices, dtype=torch.long),
-                     'edge_slices': torch.tensor(edge_slices, dtype=torch.long),
-                     'eig_vecs': torch.cat(total_eigvecs).float(),
-                     'eig_vals': torch.cat(total_eigvals).float(),
-                     'edge_indices': torch.cat(edge_indices, dim=1),
-                     'atom_features': torch.cat(all_atom_features, dim=0),
-                     'edge_features': torch.cat(all_edge_features, dim=0),
-                     'atomic_number_long': torch.tensor(data_qm9['Z'], dtype=torch.long)[:, None],
+                     'n_atoms': n_atoms,
+                     'atom_slices': atom_slices,
+                     'edge_slices': edge_slices,
+                     'eig_vecs': eig_vecs,
+                     'eig_vals': eig_vals,
+                     'edge_indices': edge_indices,
+                     'atom_features': torch.from_numpy(all_atom_features),
+                     'edge_features': edge_features,
+                     'complete_edge_features': complete_edge_features,
+                     'complete_edge_slices': complete_edge_slices,
+                     'atomic_number_long': torch.from_numpy(data_qm9['Z'].astype(np.int64))[:, None],
                      'coordinates': coordinates,
                      'targets': targets,
-                     'avg_degree': avg_degree / len(data_qm9['id'])
+                     'avg_degree': avg_degree
                      }
 
-        if not os.path.exists(os.path.join(self.qm9_directory, 'processed')):
-            os.mkdir(os.path.join(self.qm9_directory, 'processed'))
-        torch.save(data_dict, os.path.join(self.qm9_directory, 'processed', self.processed_file))
+        processed_path = os.path.join(self.qm9_directory, 'processed', self.processed_dir)
+        # graphs serialized by prefetch_graphs were built from the previous processed data
+        if os.path.exists(os.path.join(processed_path, self.graphs_file)):
+            os.remove(os.path.join(processed_path, self.graphs_file))
+        self.save_processed(data_dict, processed_path)
+
+    @staticmethod
+    def save_processed(data_dict, processed_path):
+        # raw arrays instead of a single pickle such that loading does not have to deserialize the whole dataset
+        os.makedirs(processed_path, exist_ok=True)
+        for key, value in data_dict.items():
+            np.save(os.path.join(processed_path, key + '.npy'), value.numpy() if torch.is_tensor(value) else value)
+
+    @staticmethod
+    def load_processed(processed_path):
+        data_dict = {}
+        for file_name in os.listdir(processed_path):
+            key, extension = os.path.splitext(file_name)
+            if extension != '.npy':  # e.g. the graphs serialized by prefetch_graphs
+                continue
+            # the arrays are memory mapped such that only the touched pages are read and DataLoader workers share them.
+            # Copy-on-write keeps the file intact and the arrays writable for torch.from_numpy
+            value = np.load(os.path.join(processed_path, file_name), mmap_mode=None if key == 'avg_degree' else 'c')
+            # mol_id and avg_degree were not tensors before saving
+            data_dict[key] = value if key in ('mol_id', 'avg_degree') else torch.from_numpy(value)
+        data_dict['avg_degree'] = data_dict['avg_degree'].item()
+        return data_dict
@@ -17,7 +17,7 @@ from datasets.samplers import *  # do not remove
 import seaborn as sn
 
 sn.set_theme()
-from commons.utils import get_random_indices
+from commons.utils import get_random_indices, move_to_device
 from datasets.geom_drugs_dataset import GEOMDrugs
 from datasets.geom_qm9_dataset import GEOMqm9
 from datasets.qm9_dataset import QM9Dataset
@@ -90,7 +90,8 @@ def singular_value_plot(checkpoint, i):
     train_batch = next(iter(train_loader))
     with torch.no_grad():
         info2d, info3d, *snorm_n = tuple(train_batch)
-        predictions = model(*info2d)
+        # the datasets return their samples on the cpu
+        predictions = model(*move_to_device(list(info2d), device))
 
         u, s, v = torch.pca_lowrank(predictions.detach().cpu(), q=min(predictions.shape))
 
@@ -141,9 +141,15 @@ def parse_arguments():
     p.add_argument('--collate_function', default='graph_collate', help='the collate function to use for DataLoader')
     p.add_argument('--collate_params', type=dict, default={},
                    help='parameters with keywords of the chosen collate function')
+    p.add_argument('--pin_memory', type=bool, default=False,
+                   help='let the DataLoaders pin the batches on their pin memory thread such that the copies of the '
+                        'batches to the gpu do not block the host')
+    p.add_argument('--num_workers', type=int, default=0,
+                   help='number of DataLoader worker processes. They are kept alive between epochs if > 0')
     p.add_argument('--use_e_features', default=True, type=bool, help='ignore edge features if set to False')
     p.add_argument('--targets', default=[], help='properties that should be predicted')
     p.add_argument('--device', type=str, default='cuda', help='What device to train on: cuda or cpu')
+    p.add_argument('--amp', type=bool, default=False, help='run the forward passes in bfloat16 mixed precision')
 
     p.add_argument('--dist_embedding', type=bool, default=False, help='add dist embedding to complete graphs edges')
     p.add_argument('--num_radial', type=int, default=6, help='number of frequencies for distance embedding')
@@ -297,6 +303,16 @@ def train(args):
         return train_class(args, device, metrics_dict)
 
 
+def loader_kwargs(args, collate_function):
+    kwargs = {'collate_fn': collate_function}
+    # workers are persistent such that they are not respawned and the dataset is not pickled again every epoch
+    if args.num_workers > 0:
+        kwargs.update(num_workers=args.num_workers, persistent_workers=True, prefetch_factor=4)
+    if args.pin_memory and torch.cuda.is_available():
+        kwargs.update(collate_fn=PinnedBatchCollate(collate_function), pin_memory=True)
+    return kwargs
+
+
 def train_class(args, device, metrics_dict):
     if args.dataset == 'class_hiv':
         all_data = DglGraphPropPredDataset(name='ogbg-molhiv', root=args.dataset_dir)
@@ -319,18 +335,18 @@ def train_class(args, device, metrics_dict):
                                                 indices=split_idx["train"])
         train_loader = DataLoader(Subset(all_data, split_idx["train"]),
                                   batch_sampler=sampler,
-                                  collate_fn=collate_function)
+                                  **loader_kwargs(args, collate_function))
     else:
         train_loader = DataLoader(Subset(all_data, split_idx["train"]),
                                   batch_size=args.batch_size,
                                   shuffle=True,
-                                  collate_fn=collate_function)
+                                  **loader_kwargs(args, collate_function))
     val_loader = DataLoader(Subset(all_data, split_idx["valid"]),
                             batch_size=args.batch_size,
-                            collate_fn=collate_function)
+                            **loader_kwargs(args, collate_function))
     test_loader = DataLoader(Subset(all_data, split_idx["test"]),
                              batch_size=args.batch_size,
-                             collate_fn=collate_function)
+                             **loader_kwargs(args, collate_function))
 
     metrics = {metric: metrics_dict[metric] for metric in args.metrics if metric != 'qm9_properties'}
 
@@ -355,11 +371,11 @@ def train_ogbg(args, device, metrics_dict):
         args.collate_function](**args.collate_params)
 
     train_loader = DataLoader(Subset(dataset, split_idx["train"]), batch_size=args.batch_size, shuffle=True,
-                              collate_fn=collate_function)
+                              **loader_kwargs(args, collate_function))
     val_loader = DataLoader(Subset(dataset, split_idx["valid"]), batch_size=args.batch_size, shuffle=False,
-                            collate_fn=collate_function)
+                            **loader_kwargs(args, collate_function))
     test_loader = DataLoader(Subset(dataset, split_idx["test"]), batch_size=args.batch_size, shuffle=False,
-                             collate_fn=collate_function)
+                             **loader_kwargs(args, collate_function))
 
     model, num_pretrain, transfer_from_same_dataset = load_model(args, data=dataset, device=device)
     print('model trainable params: ', sum(p.numel() for p in model.parameters() if p.requires_grad))
@@ -390,11 +406,12 @@ def train_zinc(args, device, metrics_dict):
     if args.train_sampler != None:
         sampler = globals()[args.train_sampler](data_source=train_data, batch_size=args.batch_size,
                                                 indices=range(len(train_data)))
-        train_loader = DataLoader(train_data, batch_sampler=sampler, collate_fn=collate_function)
+        train_loader = DataLoader(train_data, batch_sampler=sampler, **loader_kwargs(args, collate_function))
     else:
-        train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True, collate_fn=collate_function)
-    val_loader = DataLoader(val_data, batch_size=args.batch_size, collate_fn=collate_function)
-    test_loader = DataLoader(test_data, batch_size=args.batch_size, collate_fn=collate_function)
+        train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True,
+                                  **loader_kwargs(args, collate_function))
+    val_loader = DataLoader(val_data, batch_size=args.batch_size, **loader_kwargs(args, collate_function))
+    test_loader = DataLoader(test_data, batch_size=args.batch_size, **loader_kwargs(args, collate_function))
 
     metrics = {metric: metrics_dict[metric] for metric in args.metrics}
     trainer = get_trainer(args=args, model=model, data=train_data, device=device, metrics=metrics)
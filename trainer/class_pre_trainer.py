@@ -1,4 +1,3 @@
-import copy
 import os
 import shutil
 from typing import Dict, Callable
@@ -72,7 +71,9 @@ class CLASSTrainer(Trainer):
 
     def forward_pass(self, batch):
         graph = tuple(batch)[0]
-        graph_copy = copy.deepcopy(graph)
+        # the models only assign new node/edge features to the graph, so a local view with shared tensors is enough to
+        # keep the features that the first model writes away from the second model
+        graph_copy = graph.local_var()
         modelA_out = self.model(graph)  # forward the rest of the batch to the model
         modelB_out = self.model2(graph_copy)  # forward the rest of the batch to the model
         criticA_out = self.critic(modelA_out)
@@ -81,53 +82,34 @@ class CLASSTrainer(Trainer):
         return self.loss_func(modelA_out, modelB_out, criticA_out, criticB_out), modelA_out, modelB_out
 
     def process_batch(self, batch, optim):
-        loss, predictions, targets = self.forward_pass(batch)
+        with self.autocast():
+            loss, predictions, targets = self.forward_pass(batch)
         modelA_loss, modelB_loss, criticA_loss, criticB_loss, loss_components = loss
 
         if optim != None:  # run backpropagation if an optimizer is provided
+            # both models are updated in every step or they take turns every iterations_per_model steps
             if self.args.iterations_per_model == 0:
-                modelA_loss.backward(inputs=list(self.model.parameters()), retain_graph=True)
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1)
-                self.optim.step()
-                modelB_loss.backward(inputs=list(self.model2.parameters()), retain_graph=True)
-                torch.nn.utils.clip_grad_norm_(self.model2.parameters(), max_norm=1)
-                self.optim2.step()
-                criticA_loss.backward(inputs=list(self.critic.parameters()))
-                torch.nn.utils.clip_grad_norm_(self.critic.parameters(), max_norm=1)
-                self.optim_critic.step()
-                criticB_loss.backward(inputs=list(self.critic2.parameters()))
-                torch.nn.utils.clip_grad_norm_(self.critic2.parameters(), max_norm=1)
-                self.optim_critic2.step()
-
-                self.optim.zero_grad()
-                self.optim2.zero_grad()
-                self.optim_critic.zero_grad()
-                self.optim_critic2.zero_grad()
-                self.optim_steps += 1
+                updates = [(modelA_loss, self.model_params, self.optim), (modelB_loss, self.model2_params, self.optim2)]
+            elif (self.optim_steps // self.args.iterations_per_model) % 2 == 0:
+                updates = [(modelA_loss, self.model_params, self.optim)]
             else:
-                if (self.optim_steps // self.args.iterations_per_model) % 2 == 0:
-                    modelA_loss.backward(inputs=list(self.model.parameters()), retain_graph=True)
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1)
-                    self.optim.step()
-                    self.optim.zero_grad()
-                else:
-                    modelB_loss.backward(inputs=list(self.model2.parameters()), retain_graph=True)
-                    torch.nn.utils.clip_grad_norm_(self.model2.parameters(), max_norm=1)
-                    self.optim2.step()
-                    self.optim2.zero_grad()
-
-                criticA_loss.backward(inputs=list(self.critic.parameters()))
-                torch.nn.utils.clip_grad_norm_(self.critic.parameters(), max_norm=1)
-                self.optim_critic.step()
-                criticB_loss.backward(inputs=list(self.critic2.parameters()))
-                torch.nn.utils.clip_grad_norm_(self.critic2.parameters(), max_norm=1)
-                self.optim_critic2.step()
-
-                self.optim_critic.zero_grad()
-                self.optim_critic2.zero_grad()
-                self.optim_steps += 1
+                updates = [(modelB_loss, self.model2_params, self.optim2)]
+            for model_loss, model_params, model_optim in updates:
+                model_loss.backward(inputs=model_params, retain_graph=True)
+                torch.nn.utils.clip_grad_norm_(model_params, max_norm=1)
+                model_optim.step()
+            # each critic only enters its own loss, so both critics are updated with a single backward pass
+            (criticA_loss + criticB_loss).backward(inputs=self.critic_params + self.critic2_params)
+            torch.nn.utils.clip_grad_norm_(self.critic_params, max_norm=1)
+            self.optim_critic.step()
+            torch.nn.utils.clip_grad_norm_(self.critic2_params, max_norm=1)
+            self.optim_critic2.step()
+
+            for model_optim in [update[2] for update in updates] + [self.optim_critic, self.optim_critic2]:
+                model_optim.zero_grad(set_to_none=True)
+            self.optim_steps += 1
 
-        return modelA_loss, (predictions.detach()), (targets.detach())
+        return modelA_loss, (predictions.detach().float()), (targets.detach().float())
 
     def run_per_epoch_evaluations(self, data_loader):
         pass
@@ -151,10 +133,15 @@ class CLASSTrainer(Trainer):
         #     print(f'finish computing PCA explained variance of the {loader_name} loader outputs')
 
     def initialize_optimizer(self, optim):
-        self.optim = optim(self.model.parameters(), **self.args.optimizer_params)
-        self.optim2 = optim(self.model2.parameters(), **self.args.optimizer2_params)
-        self.optim_critic = optim(self.critic.parameters(), **self.args.optimizer_critic_params)
-        self.optim_critic2 = optim(self.critic2.parameters(), **self.args.optimizer_critic2_params)
+        # the parameter lists are kept such that process_batch does not collect them again in every step
+        self.model_params = list(self.model.parameters())
+        self.model2_params = list(self.model2.parameters())
+        self.critic_params = list(self.critic.parameters())
+        self.critic2_params = list(self.critic2.parameters())
+        self.optim = optim(self.model_params, **self.args.optimizer_params)
+        self.optim2 = optim(self.model2_params, **self.args.optimizer2_params)
+        self.optim_critic = optim(self.critic_params, **self.args.optimizer_critic_params)
+        self.optim_critic2 = optim(self.critic2_params, **self.args.optimizer_critic2_params)
 
     def save_model_state(self, epoch: int, checkpoint_name: str):
         torch.save({
@@ -229,29 +216,32 @@ class CLASSHybridBarlowTwinsTrainer(Trainer):
 
     def forward_pass(self, batch):
         graph = tuple(batch)[0]
-        graph_copy = copy.deepcopy(graph)
+        # the models only assign new node/edge features to the graph, so a local view with shared tensors is enough to
+        # keep the features that the first model writes away from the second model
+        graph_copy = graph.local_var()
         modelA_out = self.model(graph)  # forward the rest of the batch to the model
         modelB_out = self.model2(graph_copy)  # forward the rest of the batch to the model
 
         return self.loss_func(modelA_out, modelB_out), modelA_out, modelB_out
 
     def process_batch(self, batch, optim):
-        loss, predictions, targets = self.forward_pass(batch)
+        with self.autocast():
+            loss, predictions, targets = self.forward_pass(batch)
         modelA_loss, modelB_loss, loss_components = loss
 
         if optim != None:  # run backpropagation if an optimizer is provided
-            modelA_loss.backward(inputs=list(self.model.parameters()), retain_graph=True)
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1)
+            modelA_loss.backward(inputs=self.model_params, retain_graph=True)
+            torch.nn.utils.clip_grad_norm_(self.model_params, max_norm=1)
             self.optim.step()
-            modelB_loss.backward(inputs=list(self.model2.parameters()), retain_graph=True)
-            torch.nn.utils.clip_grad_norm_(self.model2.parameters(), max_norm=1)
+            modelB_loss.backward(inputs=self.model2_params, retain_graph=True)
+            torch.nn.utils.clip_grad_norm_(self.model2_params, max_norm=1)
             self.optim2.step()
 
-            self.optim.zero_grad()
-            self.optim2.zero_grad()
+            self.optim.zero_grad(set_to_none=True)
+            self.optim2.zero_grad(set_to_none=True)
             self.optim_steps += 1
 
-        return modelA_loss - modelB_loss, (predictions.detach()), (targets.detach())
+        return modelA_loss - modelB_loss, (predictions.detach().float()), (targets.detach().float())
 
     def run_per_epoch_evaluations(self, data_loader):
         pass
@@ -275,6 +265,9 @@ class CLASSHybridBarlowTwinsTrainer(Trainer):
         #     print(f'finish computing PCA explained variance of the {loader_name} loader outputs')
 
     def initialize_optimizer(self, optim):
+        # the parameter lists are kept such that process_batch does not collect them again in every step
+        self.model_params = list(self.model.parameters())
+        self.model2_params = list(self.model2.parameters())
         transferred_keys = [k for k in self.model.state_dict().keys() if
                             any(transfer_layer in k for transfer_layer in self.args.transfer_layers) and
                             not any(to_exclude in k for to_exclude in self.args.exclude_from_transfer)]
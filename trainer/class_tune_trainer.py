@@ -76,14 +76,15 @@ class CLASSFrozenFinetuneTrainer(Trainer):
         return self.loss_func(predictions, targets), predictions, targets
 
     def process_batch(self, batch, optim):
-        loss, predictions, targets = self.forward_pass(batch)
+        with self.autocast():
+            loss, predictions, targets = self.forward_pass(batch)
         if optim != None:  # run backpropagation if an optimizer is provided
             loss.backward()
             self.optim.step()
             self.after_optim_step()  # overwrite this function to do stuff before zeroing out grads
-            self.optim.zero_grad()
+            self.optim.zero_grad(set_to_none=True)
             self.optim_steps += 1
-        return loss, predictions.detach(), targets.detach()
+        return loss, predictions.detach().float(), targets.detach()
 
     def initialize_optimizer(self, optim):
         self.optim = optim(self.critic.parameters(), **self.args.optimizer_critic_params)
@@ -11,6 +11,12 @@ from commons.losses import cov_loss, uniformity_loss
 from datasets.geom_drugs_dataset import GEOMDrugs
 from datasets.qm9_dataset import QM9Dataset
 
+# Optional attributes of the metrics that the trainers check for:
+# val_only: the metric is only computed on the validation data, e.g. rocauc which needs all samples at once
+# aggregatable: Trainer.predict may stream the metric over the batches as sum(metric(batch) * len(batch)) / n_rows
+#   instead of computing it on the concatenated outputs. This is only exact if the metric is a mean over the rows of
+#   the batch with the same number of values in every row of every batch, e.g. an element-wise mean over
+#   [batch_size, n_tasks] with a fixed n_tasks. Metrics like rocauc or pearson r must not set it.
 
 class PearsonR(nn.Module):
     """
@@ -43,7 +49,7 @@ class QM9SingleTargetDenormalizedL1(nn.Module):
         self.means = dataset.targets_mean
         self.stds = dataset.targets_std
         self.eV2meV = dataset.eV2meV
-
+        self.aggregatable = True  # mean over the rows of a single column
 
     def forward(self, preds, targets):
         preds = denormalize(preds, self.means, self.stds, self.eV2meV)
@@ -62,6 +68,7 @@ class QM9DenormalizedL1(nn.Module):
         self.eV2meV = None
         if isinstance(dataset, QM9Dataset):
             self.eV2meV = dataset.eV2meV
+        self.aggregatable = True  # element-wise mean, exact as long as the number of target columns is fixed
 
     def forward(self, preds, targets):
         preds = denormalize(preds, self.means, self.stds, self.eV2meV)
@@ -73,6 +80,7 @@ class QM9DenormalizedL1(nn.Module):
 class MAE(nn.Module):
     def __init__(self, ):
         super().__init__()
+        self.aggregatable = True  # element-wise mean, exact as long as the number of target columns is fixed
 
     def forward(self, preds, targets):
         loss = F.l1_loss(preds, targets)
@@ -94,6 +102,7 @@ class QM9DenormalizedL2(nn.Module):
         self.eV2meV = None
         if isinstance(dataset, QM9Dataset):
             self.eV2meV = dataset.eV2meV
+        self.aggregatable = True  # element-wise mean, exact as long as the number of target columns is fixed
 
     def forward(self, preds, targets):
         preds = denormalize(preds, self.means, self.stds, self.eV2meV)
@@ -16,8 +16,9 @@ class OptimalTransportTrainer(Trainer):
 
     def process_batch(self, batch, optim, epoch):
         if optim != None:
-            self.optim.zero_grad()
-        loss = self.forward_pass(batch, epoch)
+            self.optim.zero_grad(set_to_none=True)
+        with self.autocast():
+            loss = self.forward_pass(batch, epoch)
         if optim != None:  # run backpropagation if an optimizer is provided
             loss.backward()
             # clip the gradients
@@ -34,7 +35,7 @@ class OptimalTransportTrainer(Trainer):
                              type(self.loss_func).__name__]}
         epoch_loss = 0
         for i, batch in enumerate(data_loader):
-            batch = move_to_device(list(batch), self.device)
+            batch = move_to_device(list(batch), self.device, non_blocking=True)
             loss = self.process_batch(batch, optim, epoch)
             with torch.no_grad():
                 if self.optim_steps % self.args.log_iterations == 0 and optim != None:
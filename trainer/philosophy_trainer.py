@@ -28,7 +28,8 @@ class PhilosophyTrainer(SelfSupervisedTrainer):
         return peasant_loss, philosopher_loss, critic_loss, view2d, view3d
 
     def process_batch(self, batch, optim):
-        peasant_loss, philosopher_loss, critic_loss, view2d, view3d = self.forward_pass(batch)
+        with self.autocast():
+            peasant_loss, philosopher_loss, critic_loss, view2d, view3d = self.forward_pass(batch)
         if optim != None:  # run backpropagation if an optimizer is provided
             peasant_loss.backward(inputs=list(self.model.parameters()), retain_graph=True)
             self.optim.step()
@@ -38,12 +39,12 @@ class PhilosophyTrainer(SelfSupervisedTrainer):
             self.optim_critic.step()
 
             self.after_optim_step()  # overwrite to do stuff before zeroing out grads
-            self.optim.zero_grad()
-            self.optim3d.zero_grad()
-            self.optim_critic.zero_grad()
+            self.optim.zero_grad(set_to_none=True)
+            self.optim3d.zero_grad(set_to_none=True)
+            self.optim_critic.zero_grad(set_to_none=True)
 
             self.optim_steps += 1
-        return peasant_loss, philosopher_loss, critic_loss, view2d.detach(), view3d.detach()
+        return peasant_loss, philosopher_loss, critic_loss, view2d.detach().float(), view3d.detach().float()
 
     def predict(self, data_loader: DataLoader, epoch: int = 0, optim: torch.optim.Optimizer = None,
                 return_predictions: bool = False) -> Tuple[Dict, Union[torch.Tensor, None], Union[torch.Tensor, None]]:
@@ -19,15 +19,16 @@ class SelfSupervisedAETrainer(SelfSupervisedTrainer):
         return loss_contrastive, loss_reconstruction, view2d, view3d
 
     def process_batch(self, batch, optim):
-        loss_contrastive,loss_reconstruction, predictions, targets = self.forward_pass(batch)
+        with self.autocast():
+            loss_contrastive,loss_reconstruction, predictions, targets = self.forward_pass(batch)
         loss = loss_contrastive + loss_reconstruction
         if optim != None:  # run backpropagation if an optimizer is provided
             loss.backward()
             self.optim.step()
             self.after_optim_step()  # overwrite this function to do stuff before zeroing out grads
-            self.optim.zero_grad()
+            self.optim.zero_grad(set_to_none=True)
             self.optim_steps += 1
-        return loss_contrastive, loss_reconstruction, predictions.detach(), targets.detach()
+        return loss_contrastive, loss_reconstruction, predictions.detach().float(), targets.detach().float()
 
     def predict(self, data_loader: DataLoader, epoch: int, optim: torch.optim.Optimizer = None,
                 return_predictions: bool = False) -> Union[
@@ -35,11 +36,11 @@ class SelfSupervisedAETrainer(SelfSupervisedTrainer):
         total_metrics = {k: 0 for k in
                          list(self.metrics.keys()) + [type(self.loss_func).__name__, 'mean_pred', 'std_pred',
                                                       'mean_targets', 'std_targets', 'contrastive_loss', 'reconstruction_loss']}
-        epoch_targets = torch.tensor([]).to(self.device)
-        epoch_predictions = torch.tensor([]).to(self.device)
+        epoch_targets = []
+        epoch_predictions = []
         epoch_loss = 0
         for i, batch in enumerate(data_loader):
-            batch = move_to_device(list(batch), self.device)
+            batch = move_to_device(list(batch), self.device, non_blocking=True)
             loss_contrastive,loss_reconstruction, predictions, targets = self.process_batch(batch, optim)
             with torch.no_grad():
                 if self.optim_steps % self.args.log_iterations == 0 and optim != None:
@@ -62,13 +63,14 @@ class SelfSupervisedAETrainer(SelfSupervisedTrainer):
                         total_metrics[key] += value
                 if optim == None and not self.val_per_batch:
                     epoch_loss += loss_contrastive.item() + loss_reconstruction.item()
-                    epoch_targets = torch.cat((targets, epoch_targets), 0)
-                    epoch_predictions = torch.cat((predictions, epoch_predictions), 0)
+                    epoch_targets.append(targets)
+                    epoch_predictions.append(predictions)
 
         if optim == None:
             if self.val_per_batch:
                 total_metrics = {k: v / len(data_loader) for k, v in total_metrics.items()}
             else:
-                total_metrics = self.evaluate_metrics(epoch_predictions, epoch_targets, val=True)
+                total_metrics = self.evaluate_metrics(torch.cat(epoch_predictions, dim=0),
+                                                      torch.cat(epoch_targets, dim=0), val=True)
                 total_metrics[type(self.loss_func).__name__] = epoch_loss / len(data_loader)
             return total_metrics
\ No newline at end of file
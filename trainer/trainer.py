@@ -19,7 +19,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 
-from commons.utils import flatten_dict, tensorboard_gradient_magnitude, move_to_device
+from commons.utils import flatten_dict, tensorboard_gradient_magnitude, move_to_device, RunningMoments
 
 
 class Trainer:
@@ -114,15 +114,21 @@ class Trainer:
         predictions = self.model(*batch[0])  # foward the rest of the batch to the model
         return self.loss_func(predictions, targets), predictions, targets
 
+    def autocast(self):
+        # context for the forward passes of process_batch and its overrides, the backward passes stay outside of it.
+        # bfloat16 has the range of float32, so unlike float16 the gradients do not need a GradScaler
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.args.amp)
+
     def process_batch(self, batch, optim):
-        loss, predictions, targets = self.forward_pass(batch)
+        with self.autocast():
+            loss, predictions, targets = self.forward_pass(batch)
         if optim != None:  # run backpropagation if an optimizer is provided
             loss.backward()
             self.optim.step()
             self.after_optim_step()  # overwrite this function to do stuff before zeroing out grads
-            self.optim.zero_grad()
+            self.optim.zero_grad(set_to_none=True)
             self.optim_steps += 1
-        return loss, predictions.detach(), targets.detach()
+        return loss, predictions.detach().float(), targets.detach()
 
     def predict(self, data_loader: DataLoader, epoch: int, optim: torch.optim.Optimizer = None,
                 return_predictions: bool = False) -> Union[
@@ -130,12 +136,19 @@ class Trainer:
         total_metrics = {k: 0 for k in
                          list(self.metrics.keys()) + [type(self.loss_func).__name__, 'mean_pred', 'std_pred',
                                                       'mean_targets', 'std_targets']}
-        epoch_targets = torch.tensor([]).to(self.device)
-        epoch_predictions = torch.tensor([]).to(self.device)
+        epoch_targets = []
+        epoch_predictions = []
+        # if all metrics are means over the samples, they are accumulated per batch and the outputs are not kept
+        stream_metrics = all(getattr(metric, 'aggregatable', False) for metric in self.metrics.values())
+        streamed_totals = {k: 0 for k in self.metrics.keys()}
+        pred_moments = RunningMoments()
+        target_moments = RunningMoments()
         epoch_loss = 0
         for i, batch in enumerate(data_loader):
             #ic(self.optim.param_groups)
-            batch = move_to_device(list(batch), self.device)
+            # with --pin_memory the DataLoader has pinned the batch on its own thread, so the copy is only queued on the
+            # stream and the host can go on launching the forward pass. Unpinned batches are copied synchronously
+            batch = move_to_device(list(batch), self.device, non_blocking=True)
             loss, predictions, targets = self.process_batch(batch, optim)
             with torch.no_grad():
                 if self.optim_steps % self.args.log_iterations == 0 and optim != None:
@@ -154,14 +167,27 @@ class Trainer:
                         total_metrics[key] += value
                 if optim == None and not self.val_per_batch:
                     epoch_loss += loss.item()
-                    epoch_targets = torch.cat((targets, epoch_targets), 0)
-                    epoch_predictions = torch.cat((predictions, epoch_predictions), 0)
+                    if stream_metrics:
+                        pred_moments.update(predictions)
+                        target_moments.update(targets)
+                        for key, metric in self.metrics.items():
+                            streamed_totals[key] += metric(predictions, targets).item() * len(targets)
+                    else:
+                        epoch_targets.append(targets)
+                        epoch_predictions.append(predictions)
 
         if optim == None:
             if self.val_per_batch:
                 total_metrics = {k: v / len(data_loader) for k, v in total_metrics.items()}
+            elif stream_metrics:
+                total_metrics = {'mean_pred': pred_moments.mean, 'std_pred': pred_moments.std,
+                                 'mean_targets': target_moments.mean, 'std_targets': target_moments.std}
+                for key, value in streamed_totals.items():
+                    total_metrics[key] = value / target_moments.n_rows if target_moments.n_rows > 0 else float('nan')
+                total_metrics[type(self.loss_func).__name__] = epoch_loss / len(data_loader)
             else:
-                total_metrics = self.evaluate_metrics(epoch_predictions, epoch_targets, val=True)
+                total_metrics = self.evaluate_metrics(torch.cat(epoch_predictions, dim=0),
+                                                      torch.cat(epoch_targets, dim=0), val=True)
                 total_metrics[type(self.loss_func).__name__] = epoch_loss / len(data_loader)
             return total_metrics
 